@@ -3,8 +3,9 @@ import pandas as pd
 import pydeck as pdk
 import numpy as np
 import requests
+import hashlib
+import orjson
 from datetime import datetime, timedelta
-from shapely.geometry import Point, Polygon
 
 # --- 1. PAGE CONFIGURATION ---
 st.set_page_config(
@@ -16,6 +17,17 @@ st.set_page_config(
 
 # --- 2. HELPER FUNCTIONS ---
 
+@st.cache_resource(show_spinner=False)
+def get_http_session():
+    """
+    Shared requests.Session so API calls reuse pooled keep-alive connections.
+    Cached as a resource because a module-level session would be recreated
+    on every Streamlit rerun.
+    """
+    session = requests.Session()
+    session.headers["User-Agent"] = "velocirrus/1.0"
+    return session
+
 @st.cache_data(ttl=300) # Cache data for 5 mins to avoid hitting API limits
 def get_opensky_data():
     """
@@ -33,73 +45,160 @@ def get_opensky_data():
     }
     
     try:
-        response = requests.get(url, params=params, timeout=10)
+        response = get_http_session().get(url, params=params, timeout=10)
         response.raise_for_status()
-        json_data = response.json()
-        
-        # OpenSky returns a list of lists. We need to map them to columns.
-        col_names = ["icao24", "callsign", "origin_country", "time_position", 
-                     "last_contact", "longitude", "latitude", "baro_altitude", 
-                     "on_ground", "velocity", "true_track", "vertical_rate", 
-                     "sensors", "geo_altitude", "squawk", "spi", "position_source"]
-        
-        if json_data['states'] is None:
-            return pd.DataFrame(columns=col_names)
-            
-        df = pd.DataFrame(json_data['states'], columns=col_names)
-        
-        # Clean data: Ensure numerics and remove nulls
-        df = df.dropna(subset=["longitude", "latitude", "baro_altitude"])
-        df["baro_altitude"] = pd.to_numeric(df["baro_altitude"])
-        
-        # Filter for cruising altitude (approx > 20,000 ft / 6000m)
-        df = df[df["baro_altitude"] > 6000]
+        json_data = orjson.loads(response.content) # Faster than stdlib json for large state lists
         
-        return df
+        # OpenSky returns a list of lists (state vectors). Only 4 of the 17
+        # fields are used, so pull those straight into numpy arrays.
+        # Indices: 1 callsign, 5 longitude, 6 latitude, 7 baro_altitude
+        states = json_data['states'] or []
+        n = len(states)
+
+        def column(idx):
+            # Unknown values arrive as null; map them to NaN
+            return np.fromiter(
+                (np.nan if s[idx] is None else s[idx] for s in states),
+                dtype=np.float32, count=n
+            )
+
+        lon, lat, alt = column(5), column(6), column(7)
+        callsign = np.array([(s[1] or "").strip() for s in states], dtype=object)
+
+        # Clean data: remove nulls and keep cruising altitude
+        # (approx > 20,000 ft / 6000m; NaN altitudes compare False)
+        keep = np.isfinite(lon) & np.isfinite(lat) & (alt > 6000)
+
+        return {
+            "longitude": lon[keep],
+            "latitude": lat[keep],
+            "altitude": alt[keep],
+            "callsign": callsign[keep],
+        }
         
     except Exception as e:
         st.sidebar.error(f"OpenSky API Error: {e}")
         return None
 
-@st.cache_data
-def get_google_contrail_zones(api_key, time_iso):
+@st.cache_data(ttl=300, show_spinner=False) # Refresh forecast every 5 mins
+def get_google_contrail_zones(_api_key, key_digest, time_iso):
     """
     Fetches real Contrail Likely Zones (CLZs) from Google's API.
+    The secret itself is not hashed (leading underscore); key_digest, a SHA-256
+    of it, keys the cache per API key. Errors are raised, so failures aren't cached.
     """
     url = "https://contrails.googleapis.com/v2/regions"
     params = {
-        "key": api_key,
+        "key": _api_key,
         "time": time_iso
     }
-    try:
-        response = requests.get(url, params=params)
-        response.raise_for_status()
-        data = response.json()
-        
-        zones = []
-        if 'features' in data:
-            for feature in data['features']:
-                coords = feature['geometry']['coordinates'][0] 
-                zones.append({
-                    "path": coords,
-                    "color": [255, 0, 0, 120],
-                    "name": "Google Predicted CLZ"
-                })
-        return zones
-    except Exception as e:
-        st.sidebar.error(f"Google API Error: {str(e)}")
-        return None
+    response = get_http_session().get(url, params=params, timeout=10)
+    response.raise_for_status()
+    data = response.json()
+    
+    zones = []
+    if 'features' in data:
+        for feature in data['features']:
+            coords = feature['geometry']['coordinates'][0] 
+            zones.append({
+                "coords": np.asarray(coords, dtype=np.float64), # (V, 2) lon/lat
+                "color": [255, 0, 0, 120],
+                "name": "Google Predicted CLZ"
+            })
+    return zones
+
+@st.cache_resource(show_spinner=False)
+def _build_mock_flight_path(callsign):
+    """Simulated LHR -> JFK track, built once per callsign"""
+    i = np.arange(100)
+    # float32 to match the live OpenSky arrays (and deck.gl's float32 positions)
+    return pd.DataFrame({
+        "longitude": np.linspace(-0.45, -73.77, 100, dtype=np.float32),
+        "latitude": np.linspace(51.47, 40.64, 100, dtype=np.float32),
+        "altitude": np.linspace(10668, 11887, 100, dtype=np.float32),
+        "callsign": [callsign] * 100, # Added callsign for tooltip
+        "ef": np.where((i > 30) & (i < 70), 50 * np.sin(i / 10.0), 0.0).astype(np.float32)
+    })
+
+def generate_mock_flight_path(callsign="DEMO"):
+    """Fallback mock flight (shallow copy so added columns stay out of the cache)"""
+    return _build_mock_flight_path(callsign).copy(deep=False)
 
-@st.cache_data
+# cache_resource: returned as-is, without cache_data's hashing/pickling per rerun
+@st.cache_resource(show_spinner=False)
 def generate_mock_contrail_zones():
     """Fallback mock zones"""
     p1 = [[-40, 45], [-30, 45], [-30, 50], [-40, 50], [-40, 45]]
     p2 = [[-20, 48], [-15, 48], [-15, 52], [-20, 52], [-20, 48]]
     return [
-        {"name": "Zone Alpha (Simulated)", "path": p1, "color": [255, 0, 0, 100]},
-        {"name": "Zone Beta (Simulated)", "path": p2, "color": [255, 140, 0, 100]}
+        {"name": "Zone Alpha (Simulated)", "coords": np.asarray(p1, dtype=np.float64), "color": [255, 0, 0, 100]},
+        {"name": "Zone Beta (Simulated)", "coords": np.asarray(p2, dtype=np.float64), "color": [255, 140, 0, 100]}
     ]
 
+def pack_zone_rings(zone_coords):
+    """
+    Flattens per-zone (V, 2) rings into one (sum V, 2) array plus ring offsets,
+    so zone i spans coords[offsets[i]:offsets[i + 1]].
+    """
+    coords = np.concatenate([np.zeros((0, 2))] + list(zone_coords))
+    offsets = np.cumsum([0] + [len(c) for c in zone_coords], dtype=np.int64)
+    return coords, offsets
+
+@st.cache_resource(show_spinner=False)
+def build_zone_index(zone_coords):
+    """Cached, prepared zone Polygons (one ragged-array call) and their STRtree"""
+    # Deferred: only Live Data needs shapely
+    from shapely import GeometryType, STRtree, from_ragged_array, prepare
+
+    if not zone_coords:
+        return STRtree([]), np.empty(0, dtype=object)
+
+    coords, ring_offsets = pack_zone_rings(zone_coords)
+    polygon_offsets = np.arange(len(zone_coords) + 1)
+    polys = from_ragged_array(GeometryType.POLYGON, coords, (ring_offsets, polygon_offsets))
+    prepare(polys)
+    return STRtree(polys), polys
+
+@st.cache_data(ttl=300, show_spinner=False)
+def render_deck_html(signature, _deck):
+    """Serializes the deck to standalone HTML once per distinct signature"""
+    return _deck.to_html(as_string=True)
+
+# Up to this many zones a direct per-zone sweep beats building an STRtree
+SMALL_ZONE_COUNT = 100
+
+@st.cache_resource(show_spinner=False)
+def get_pip_kernel():
+    """
+    JIT-compiles the Numba point-in-polygon kernel once per process.
+    Numba is optional: returns None when it isn't installed.
+    """
+    try:
+        import numba
+    except ImportError:
+        return None
+
+    # Serial: Numba's parallel workqueue aborts when called from Streamlit's session threads
+    @numba.njit(fastmath=True)
+    def pip_any(lons, lats, coords, offsets, out):
+        # Crossing-number test; out[i] = 1 if point i lies in any ring
+        for i in range(lons.size):
+            x, y = lons[i], lats[i]
+            for z in range(offsets.size - 1):
+                inside = False
+                j = offsets[z + 1] - 1
+                for k in range(offsets[z], offsets[z + 1]):
+                    xk, yk = coords[k, 0], coords[k, 1]
+                    xj, yj = coords[j, 0], coords[j, 1]
+                    if (yk > y) != (yj > y) and x < (xj - xk) * (y - yk) / (yj - yk) + xk:
+                        inside = not inside
+                    j = k
+                if inside:
+                    out[i] = 1
+                    break
+
+    return pip_any
+
 # --- 3. SIDEBAR & CONTROLS ---
 st.sidebar.header("🛸 Velocirrus Flight Deck")
 
@@ -135,13 +234,7 @@ total_flights = 0
 
 # --- LOGIC BRANCHING ---
 if data_source == "Demo Mode (Simulation)":
-    flight_df = pd.DataFrame({
-        "longitude": np.linspace(-0.45, -73.77, 100),
-        "latitude": np.linspace(51.47, 40.64, 100),
-        "altitude": np.linspace(10668, 11887, 100),
-        "callsign": ["DEMO"] * 100, # Added callsign for tooltip
-        "ef": [50 * np.sin(i/10) if 30 < i < 70 else 0 for i in range(100)]
-    })
+    flight_df = generate_mock_flight_path("DEMO")
     zones_data = generate_mock_contrail_zones()
     total_flights = 1
 
@@ -149,10 +242,16 @@ else:
     # --- LIVE DATA EXECUTION ---
     with st.spinner("Scanning Atmosphere & Traffic..."):
         # 1. Contrail Zones
-        current_time = datetime.utcnow().isoformat() + "Z"
-        
+        # Truncated to the hour so reruns share one cache entry per forecast hour
+        current_time = datetime.utcnow().replace(minute=0, second=0, microsecond=0).isoformat() + "Z"
+
         if google_api_key:
-            real_zones = get_google_contrail_zones(google_api_key, current_time)
+            key_digest = hashlib.sha256(google_api_key.encode()).hexdigest()
+            try:
+                real_zones = get_google_contrail_zones(google_api_key, key_digest, current_time)
+            except Exception as e:
+                st.sidebar.error(f"Google API Error: {str(e)}")
+                real_zones = None
             if real_zones:
                 zones_data = real_zones
                 st.toast("Connected to Google Contrails API", icon="☁️")
@@ -162,58 +261,79 @@ else:
             zones_data = generate_mock_contrail_zones()
 
         # 2. Live Flights (Direct API Call)
-        live_df = get_opensky_data()
-        
-        if live_df is not None and not live_df.empty:
-            flight_df = live_df.rename(columns={"baro_altitude": "altitude"})
-            
+        live_data = get_opensky_data()
+
+        if live_data is not None and len(live_data["longitude"]) > 0:
+            flight_df = pd.DataFrame(live_data)
+
             # 3. Intersection Logic
-            polys = [Polygon(z['path']) for z in zones_data]
-            
-            def check_risk(row):
-                # Check if flight point is inside any Contrail Zone polygon
-                pt = Point(row['longitude'], row['latitude'])
-                for poly in polys:
-                    if poly.contains(pt):
-                        return 50 # High Risk
-                return 0 # Low Risk
-
-            if not flight_df.empty:
-                flight_df['ef'] = flight_df.apply(check_risk, axis=1)
-                total_flights = len(flight_df)
-                st.success(f"Tracking {total_flights} live flights.")
+            lons = flight_df['longitude'].to_numpy()
+            lats = flight_df['latitude'].to_numpy()
+            zone_coords = tuple(z['coords'] for z in zones_data)
+            pip_kernel = get_pip_kernel() if len(zone_coords) <= SMALL_ZONE_COUNT else None
+
+            if pip_kernel is not None:
+                # Few zones: Numba sweep over the flat rings, no shapely objects
+                coords, offsets = pack_zone_rings(zone_coords)
+                in_zone = np.zeros(len(flight_df), dtype=np.uint8)
+                pip_kernel(lons, lats, coords, offsets, in_zone)
+            else:
+                from shapely import contains, points
+
+                tree, polys = build_zone_index(zone_coords)
+                pts = points(lons, lats) # All flights in one C call
+                in_zone = np.zeros(len(flight_df), dtype=bool)
+
+                if len(polys) <= SMALL_ZONE_COUNT:
+                    # Few zones: one vectorized prepared contains() per zone,
+                    # i.e. a Python loop over zones rather than flights
+                    for poly in polys:
+                        in_zone |= contains(poly, pts)
+                else:
+                    # Many zones: the tree yields (point, zone) bounding-box
+                    # candidates, each confirmed with the prepared zone's contains()
+                    pt_idx, zone_idx = tree.query(pts)
+                    hits = contains(polys[zone_idx], pts[pt_idx])
+                    in_zone[pt_idx[hits]] = True
+
+            flight_df['ef'] = np.where(in_zone, 50, 0).astype(np.int32) # 50 = High Risk, 0 = Low Risk
+            total_flights = len(flight_df)
+            st.success(f"Tracking {total_flights} live flights.")
         else:
             st.warning("No live flights found in zone or API limit reached. Showing Simulation.")
             # Fallback to simulation if live data fails
-            flight_df = pd.DataFrame({
-                "longitude": np.linspace(-0.45, -73.77, 100),
-                "latitude": np.linspace(51.47, 40.64, 100),
-                "altitude": np.linspace(10668, 11887, 100),
-                "callsign": ["SIMULATED"] * 100,
-                "ef": [50 * np.sin(i/10) if 30 < i < 70 else 0 for i in range(100)]
-            })
+            flight_df = generate_mock_flight_path("SIMULATED")
             zones_data = generate_mock_contrail_zones()
             total_flights = 1
 
 # --- 5. COLOR LOGIC ---
-def get_color(ef_value):
-    if ef_value > 10:
-        return [255, 0, 0, 200] # Red (Contrail Formation Likely)
-    else:
-        return [0, 255, 100, 200] # Green (Safe)
+# Row 0: Green (Safe), Row 1: Red (Contrail Formation Likely)
+RISK_PALETTE = np.array([[0, 255, 100, 200], [255, 0, 0, 200]], dtype=np.uint8)
+
+# Checked once and reused below instead of re-scanning flight_df each time
+is_empty = flight_df.empty
+ef_arr = flight_df["ef"].to_numpy() if not is_empty else np.empty(0)
+high_risk = int((ef_arr > 0).sum())
 
-if not flight_df.empty:
-    flight_df["color"] = flight_df["ef"].apply(get_color)
+if not is_empty:
+    high_risk_mask = ef_arr > 10
+    flight_df["color"] = RISK_PALETTE[high_risk_mask.astype(np.int8)].tolist()
 
 # --- 6. VISUALIZATION ---
 view_state = pdk.ViewState(latitude=48.0, longitude=-30.0, zoom=3, pitch=45)
 
+# One record per zone, built from its (V, 2) coords array
+zones_layer_data = [
+    {"polygon": z["coords"].tolist(), "color": z["color"], "name": z["name"]}
+    for z in zones_data
+]
+
 zones_layer = pdk.Layer(
     "PolygonLayer",
-    zones_data,
-    get_polygon="path",
+    zones_layer_data,
+    get_polygon="polygon",
     get_fill_color="color",
-    get_line_color=[255, 255, 255],
+    get_line_color=[255, 255, 255], # Constant: deck.gl needs no per-vertex buffer for it
     line_width_min_pixels=1,
     opacity=0.4,
     pickable=True,
@@ -225,7 +345,7 @@ flight_layer = pdk.Layer(
     "ScatterplotLayer",
     data=flight_df,
     get_position=["longitude", "latitude", "altitude"],
-    get_color="color",
+    get_fill_color="color",
     get_radius=8000,
     pickable=True,
     opacity=0.9,
@@ -238,11 +358,18 @@ r = pdk.Deck(
     map_style="mapbox://styles/mapbox/dark-v10"
 )
 
+# Signature: flight frame, each zone's ring/color/name, and the view state
+deck_signature = (
+    flight_df.drop(columns="color", errors="ignore"),
+    tuple((z["coords"], z["color"], z["name"]) for z in zones_data),
+    (view_state.latitude, view_state.longitude, view_state.zoom, view_state.pitch),
+)
+
 with map_container:
-    st.pydeck_chart(r)
+    st.iframe(render_deck_html(deck_signature, r), height=620)
 
 # --- 7. METRICS ---
-if not flight_df.empty:
+if not is_empty:
     col1.metric("Live Flights Tracked", total_flights)
-    col2.metric("High Risk Intersections", len(flight_df[flight_df['ef'] > 0]))
+    col2.metric("High Risk Intersections", high_risk)
     col3.metric("Data Source", "Google API" if google_api_key else "Simulation Engine")
\ No newline at end of file